@@ -6,13 +6,29 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support import expected_conditions as EC
 import subprocess
+import atexit
+import tempfile
+import hashlib
+import io
+import http.server
+import shutil
 import sys
 import re
+import time
+import threading
+import queue
+import itertools
+import urllib.request
+import urllib.error
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import tkinter as tk
 from tkinter import filedialog
 import logging
 import pandas as pd
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, urljoin
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 
 logging.disable(logging.CRITICAL)  # 禁用所有日志
@@ -44,6 +60,33 @@ def clean_file_path(input_path):
     return input_path.strip().replace('"', '').replace("'", "")
 
 
+# 读取链接表格，返回所有表格（CSV 为一个，Excel 为每个工作表一个）的 DataFrame
+def read_links_tables(file_path):
+    # 判断文件类型，处理 CSV 文件
+    if file_path.endswith('.csv'):
+        try:
+            # 尝试用 utf-8 编码打开文件
+            df = pd.read_csv(file_path, encoding='utf-8')
+        except UnicodeDecodeError:
+            # 如果 utf-8 编码失败，尝试用 gbk 编码
+            try:
+                df = pd.read_csv(file_path, encoding='gbk')
+            except UnicodeDecodeError:
+                print(f"文件 {file_path} 使用的编码无法识别，请尝试其他编码格式。")
+                sys.exit(1)
+        return [df]
+
+    # 判断文件类型，处理 Excel 文件
+    elif file_path.endswith(('.xlsx', '.xls')):  # Excel 文件
+        # 读取整个 Excel 文件
+        xls = pd.ExcelFile(file_path)
+        # 遍历每个工作表
+        return [pd.read_excel(xls, sheet_name=sheet_name) for sheet_name in xls.sheet_names]
+
+    else:
+        raise ValueError(f"文件格式不支持: {file_path}. 请使用CSV或Excel文件。")
+
+
 def read_links_file(file_path):
     try:
         # 清理文件路径
@@ -52,43 +95,14 @@ def read_links_file(file_path):
         # 存储找到的链接
         links = {}
 
-        # 判断文件类型，处理 CSV 文件
-        if file_path.endswith('.csv'):
-            try:
-                # 尝试用 utf-8 编码打开文件
-                df = pd.read_csv(file_path, encoding='utf-8')
-            except UnicodeDecodeError:
-                # 如果 utf-8 编码失败，尝试用 gbk 编码
-                try:
-                    df = pd.read_csv(file_path, encoding='gbk')
-                except UnicodeDecodeError:
-                    print(f"文件 {file_path} 使用的编码无法识别，请尝试其他编码格式。")
-                    sys.exit(1)
-
-            # 遍历 CSV 中所有列和每列的每一行
+        for df in read_links_tables(file_path):
+            # 遍历表格中的每一列
             for col in df.columns:
                 # 遍历每个单元格，检查链接
                 for i, value in df[col].dropna().items():
                     if isinstance(value, str) and value.startswith("https://n.dingtalk.com"):
                         links[i] = value  # 保存符合条件的链接
 
-        # 判断文件类型，处理 Excel 文件
-        elif file_path.endswith(('.xlsx', '.xls')):  # Excel 文件
-            # 读取整个 Excel 文件
-            xls = pd.ExcelFile(file_path)
-            # 遍历每个工作表
-            for sheet_name in xls.sheet_names:
-                df = pd.read_excel(xls, sheet_name=sheet_name)
-                # 遍历工作表中的每一列
-                for col in df.columns:
-                    # 遍历每个单元格，检查链接
-                    for i, value in df[col].dropna().items():
-                        if isinstance(value, str) and value.startswith("https://n.dingtalk.com"):
-                            links[i] = value  # 保存符合条件的链接
-
-        else:
-            raise ValueError(f"文件格式不支持: {file_path}. 请使用CSV或Excel文件。")
-
         if not links:
             raise ValueError("未找到有效的钉钉直播链接。")
 
@@ -98,6 +112,26 @@ def read_links_file(file_path):
         print(f"读取文件时发生错误: {e}")
         sys.exit(1)
 
+# 表格中优先级列可使用的列名
+PRIORITY_COLUMN_NAMES = ('优先级', 'priority', 'Priority')
+
+# 读取表格中的优先级列，返回 {行号: 优先级}，数值越小越先下载
+def read_links_priority(file_path):
+    priorities = {}
+    try:
+        for df in read_links_tables(clean_file_path(file_path)):
+            for col in df.columns:
+                if str(col).strip() not in PRIORITY_COLUMN_NAMES:
+                    continue
+                for i, value in pd.to_numeric(df[col], errors='coerce').dropna().items():
+                    priorities[i] = float(value)
+    except Exception as e:
+        print(f"读取优先级列时发生错误: {e}")
+
+    if not priorities:
+        print(f"表格中未找到优先级列（列名: {'、'.join(PRIORITY_COLUMN_NAMES)}），将按表格顺序下载。")
+    return priorities
+
 
 # 获取浏览器Cookie的函数
 def get_browser_cookie(url, browser_type='edge'):
@@ -248,34 +282,121 @@ def repeat_get_browser_cookie(url):
             browser.quit()
         sys.exit(1)
 
-def repeat_process_links(new_links_dict, browser, browser_type, save_mode):
+# 批量下载的调度策略
+SCHEDULE_POLICIES = {'1': 'fifo', '2': 'shortest', '3': 'longest', '4': 'priority'}
+
+# 计算任务在下载队列中的排序键，值越小越先下载
+def get_schedule_key(job, policy):
+    if policy == 'shortest':
+        # 时长未知的任务排在最后
+        return (job['duration'] or float('inf'), job['order'])
+    if policy == 'longest':
+        # 先下载最长的视频，多个下载线程可以更早同时结束
+        return (-job['duration'], job['order'])
+    if policy == 'priority':
+        return (job['priority'], job['order'])
+    return (job['order'], 0)
+
+# 下载线程：从队列中取出当前排序最靠前的任务进行下载，取到 None 时退出
+def download_worker(download_queue, save_mode, saved_path, total_links):
+    while True:
+        _, _, job = download_queue.get()
+        if job is None:
+            break
+        print(f"正在下载第 {job['order'] + 1} 个视频（{job['save_name']}，时长约 {job['duration'] / 60:.1f} 分钟），共 {total_links} 个视频。")
+        try:
+            if save_mode == '1':
+                auto_download_m3u8_with_options(job['m3u8_file'], job['save_name'], job['prefix'], job['cookies_data'], job['headers'], job)  # 默认下载到 Downloads
+            elif save_mode == '2':
+                download_m3u8_with_reused_path(job['m3u8_file'], job['save_name'], job['prefix'], saved_path, job['cookies_data'], job['headers'], job)  # 手动选择路径
+        except Exception as e:
+            print(f"下载第 {job['order'] + 1} 个视频时发生错误: {e}")
+        print('=' * 100)
+
+def process_links(links_dict, browser, browser_type, save_mode, saved_path=None, schedule_policy='fifo', priorities=None, parallel_count=1, first_session=None):
     """
-    继续处理新输入的钉钉直播回放链接，并下载视频。
+    解析钉钉直播回放链接并按调度策略下载视频。
+    链接在主线程中依次通过浏览器解析，解析完成的任务进入优先队列，下载线程每次取出当前排序最靠前的任务。
+    按表格顺序下载时边解析边下载；其他策略需要比较全部任务，链接全部解析完成后才开始下载
+    （签名链接在任务开始下载时会检查过期时间并重新解析，等待解析不会导致链接失效）。
+    first_session 为已通过 get_browser_cookie 获取的第一个链接的 (Cookie, 请求头, 直播名称)。
     """
-    total_links = len(new_links_dict)
-    print(f"共提取到 {total_links} 个新的钉钉直播回放分享链接。")
+    total_links = len(links_dict)
+    priorities = priorities or {}
 
-    saved_path = None  # 用于保存路径
-    for idx, dingtalk_url in new_links_dict.items():
-        print(f"正在下载第 {idx + 1} 个视频，共 {total_links} 个视频。")
-        cookies_data, m3u8_headers, live_name = repeat_get_browser_cookie(dingtalk_url)
-        m3u8_links = fetch_m3u8_links(browser, browser_type, dingtalk_url)
-
-        if m3u8_links:
-            for link in m3u8_links:
-                m3u8_file = download_m3u8_file(link, 'output.m3u8', m3u8_headers)
-                prefix = extract_prefix(link)
-                save_name = live_name
+    # 多个下载线程不能弹出目录选择框，需要提前选择保存路径
+    if save_mode == '2' and saved_path is None:
+        root = tk.Tk()
+        root.withdraw()
+        saved_path = filedialog.askdirectory(title="选择保存视频的目录")
 
-                if save_mode == '1':
-                    saved_path = auto_download_m3u8_with_options(m3u8_file, save_name, prefix, cookies_data, m3u8_headers)  # 默认下载到 Downloads
-                elif save_mode == '2':
-                    saved_path = download_m3u8_with_reused_path(m3u8_file, save_name, prefix, saved_path, cookies_data, m3u8_headers)  # 手动选择路径
+        if not saved_path:
+            print("用户取消了选择。视频下载已中止。")
+            return None
+
+    download_queue = queue.PriorityQueue()
+    counter = itertools.count()
+    workers = [threading.Thread(target=download_worker, args=(download_queue, save_mode, saved_path, total_links), daemon=True)
+               for _ in range(parallel_count)]
+    if schedule_policy == 'fifo':
+        for worker in workers:
+            worker.start()
+
+    used_names = set()
+    for order, (idx, dingtalk_url) in enumerate(links_dict.items()):
+        print(f"正在解析第 {order + 1} 个链接，共 {total_links} 个链接。")
+        with browser_lock:
+            if order == 0 and first_session is not None:
+                cookies_data, m3u8_headers, live_name = first_session
+            else:
+                cookies_data, m3u8_headers, live_name = repeat_get_browser_cookie(dingtalk_url)
+            m3u8_links = fetch_m3u8_links(browser, browser_type, dingtalk_url)
 
-        print('=' * 100)
+            if not m3u8_links:
+                print(f"第 {order + 1} 个链接未找到 m3u8 链接，已跳过。")
+                continue
+
+            link = m3u8_links[0]
+            # 并行下载时每个任务使用独立的播放列表文件
+            m3u8_file = download_m3u8_file(link, new_playlist_file(), m3u8_headers)
+
+        job = create_download_job(browser, browser_type, dingtalk_url, link, m3u8_file, cookies_data, m3u8_headers)
+        job['order'] = order
+        job['priority'] = priorities.get(idx, float('inf'))
+        # 同名直播会使用相同的临时目录，需要区分保存名称
+        job['save_name'] = live_name if live_name not in used_names else f"{live_name}_{order + 1}"
+        used_names.add(job['save_name'])
+
+        download_queue.put((get_schedule_key(job, schedule_policy), next(counter), job))
+        print(f"已加入下载队列: {job['save_name']}，时长约 {job['duration'] / 60:.1f} 分钟，共 {job['segment_count']} 个分片")
+        # 边解析边下载时，下载线程可能正在等待用户处理磁盘空间不足
+        handle_disk_space_prompts()
+
+    if schedule_policy != 'fifo':
+        print(f"链接已全部解析，共 {download_queue.qsize()} 个视频，开始按调度顺序下载。")
+        for worker in workers:
+            worker.start()
+
+    # 每个下载线程取到一个结束标记后退出
+    for _ in workers:
+        download_queue.put(((float('inf'), float('inf'), float('inf')), next(counter), None))
+    # 等待下载完成，期间代下载线程询问用户
+    while any(worker.is_alive() for worker in workers):
+        handle_disk_space_prompts(timeout=1)
+    for worker in workers:
+        worker.join()
 
     return saved_path
 
+def repeat_process_links(new_links_dict, browser, browser_type, save_mode, saved_path=None, schedule_policy='fifo', priorities=None, parallel_count=1):
+    """
+    继续处理新输入的钉钉直播回放链接，并下载视频。
+    """
+    total_links = len(new_links_dict)
+    print(f"共提取到 {total_links} 个新的钉钉直播回放分享链接。")
+
+    return process_links(new_links_dict, browser, browser_type, save_mode, saved_path, schedule_policy, priorities, parallel_count)
+
 
 def continue_download(saved_path, browser, browser_type):
     """
@@ -400,6 +521,14 @@ def refresh_page_by_click(browser):
         print(f"刷新页面时发生错误: {e}")
 
 
+# 播放列表保存在临时目录中，每个下载任务使用独立的文件，程序退出时删除
+PLAYLIST_DIR = tempfile.mkdtemp(prefix='dingtalk_m3u8_')
+atexit.register(shutil.rmtree, PLAYLIST_DIR, ignore_errors=True)
+playlist_counter = itertools.count(1)
+
+def new_playlist_file():
+    return os.path.join(PLAYLIST_DIR, f"output_{next(playlist_counter)}.m3u8")
+
 def download_m3u8_file(url, filename, headers):
     global browser
     m3u8_content = browser.execute_script("return fetch(arguments[0], { method: 'GET', headers: arguments[1] }).then(response => response.text())", url)
@@ -414,21 +543,750 @@ def extract_prefix(url):
     match = pattern.search(url)
     return match.group(1) if match else url
 
-def download_m3u8_with_options(m3u8_file, save_name, prefix, cookies_data=None, headers=None):
-    root = tk.Tk()
-    root.withdraw()
-    save_dir = filedialog.askdirectory(title="选择保存视频的目录")
+# 签名链接剩余有效期小于该值（秒）时，在下载前重新解析链接
+URL_EXPIRE_MARGIN = 10 * 60
+# 单个下载任务重新解析 m3u8 链接的最大次数
+MAX_REFRESH_TIMES = 3
+# 浏览器同一时间只能处理一个页面，解析链接时需要加锁
+browser_lock = threading.RLock()
+
+# 从签名链接中解析过期时间（Unix 时间戳），无法解析时返回 None
+def get_url_expire_time(url):
+    query_params = parse_qs(urlparse(url).query)
+
+    # 阿里云 CDN 鉴权参数 auth_key=timestamp-rand-uid-md5hash，其中 timestamp 为失效时间
+    auth_key = query_params.get('auth_key', [None])[0]
+    if auth_key:
+        timestamp = auth_key.split('-')[0]
+        if timestamp.isdigit():
+            return int(timestamp)
+
+    # OSS 等签名链接使用 Expires 参数表示失效时间
+    for name in ('Expires', 'expires'):
+        value = query_params.get(name, [None])[0]
+        if value and value.isdigit():
+            return int(value)
+
+    return None
+
+# 获取 m3u8 链接及播放列表中分片链接最早的过期时间
+def get_playlist_expire_time(link, m3u8_file=None):
+    expire_times = []
+    link_expire_time = get_url_expire_time(link)
+    if link_expire_time:
+        expire_times.append(link_expire_time)
+
+    if m3u8_file and os.path.exists(m3u8_file):
+        with open(m3u8_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    segment_expire_time = get_url_expire_time(line)
+                    if segment_expire_time:
+                        expire_times.append(segment_expire_time)
+
+    return min(expire_times) if expire_times else None
+
+def is_url_expiring(expire_time, margin=URL_EXPIRE_MARGIN):
+    return expire_time is not None and expire_time - time.time() < margin
+
+# 创建下载任务，记录重新解析签名链接所需的浏览器会话信息
+def create_download_job(browser, browser_type, dingtalk_url, link, m3u8_file, cookies_data, headers):
+    return {
+        'browser': browser,
+        'browser_type': browser_type,
+        'dingtalk_url': dingtalk_url,
+        'link': link,
+        'm3u8_file': m3u8_file,
+        'prefix': extract_prefix(link),
+        'cookies_data': cookies_data,
+        'headers': headers,
+        'expire_time': get_playlist_expire_time(link, m3u8_file),
+        'refresh_count': 0,
+        **get_playlist_stats(m3u8_file, extract_prefix(link)),
+    }
+
+# 获取比任务当前链接过期更晚的 m3u8 链接，页面仍在使用旧链接时重新加载页面
+def get_refreshed_link(job, attempts=3):
+    old_expire_time = get_url_expire_time(job['link'])
+    for attempt in range(attempts):
+        m3u8_links = fetch_m3u8_links(job['browser'], job['browser_type'], job['dingtalk_url'])
+        if not m3u8_links:
+            return None
+
+        link = m3u8_links[0]
+        # 链接不带过期时间时无法比较，直接使用
+        if old_expire_time is None:
+            return link
+        expire_time = get_url_expire_time(link)
+        if expire_time is not None and expire_time > old_expire_time:
+            return link
+
+        print(f"第 {attempt + 1} 次获取到的仍是旧的 m3u8 链接，重新加载页面...")
+        refresh_page_by_click(job['browser'])
+
+    return None
+
+# 通过现有浏览器会话重新解析 m3u8 链接，并更新任务中的播放列表、Cookie 和过期时间
+def refresh_download_job(job):
+    if job['refresh_count'] >= MAX_REFRESH_TIMES:
+        print(f"已重新解析 {MAX_REFRESH_TIMES} 次，不再重试。")
+        return False
+    job['refresh_count'] += 1
+    print(f"正在重新解析 m3u8 链接（第 {job['refresh_count']} 次）...")
 
-    if not save_dir:
-        print("用户取消了选择。视频下载已中止。")
+    try:
+        # 批量下载时多个下载线程共用同一个浏览器
+        with browser_lock:
+            # Chrome 和 Edge 的性能日志中仍缓存着旧页面的请求，导航前先丢弃，避免再次取到旧的签名链接
+            if job['browser_type'] == 'chrome' or job['browser_type'] == 'edge':
+                job['browser'].get_log("performance")
+            job['browser'].get(job['dingtalk_url'])
+
+            link = get_refreshed_link(job)
+            if not link:
+                print("重新解析 m3u8 链接失败。")
+                return False
+
+            job['m3u8_file'] = download_m3u8_file(link, job['m3u8_file'], job['headers'])
+            job['cookies_data'] = {cookie['name']: cookie['value'] for cookie in job['browser'].get_cookies()}
+        job['link'] = link
+        job['prefix'] = extract_prefix(link)
+        job['expire_time'] = get_playlist_expire_time(link, job['m3u8_file'])
+    except Exception as e:
+        print(f"重新解析 m3u8 链接时发生错误: {e}")
+        return False
+
+    return True
+
+# 预计磁盘占用超过总容量的该比例时，暂停开始新的下载
+DISK_USAGE_WATERMARK = 0.95
+# N_m3u8DL-RE 合并时分片和合并后的文件同时存在，需要预留约两倍的空间
+MERGE_SPACE_FACTOR = 2
+# 下载过程中文件名使用的后缀，下载成功后重命名为正式文件名
+TEMP_SUFFIX = '.downloading'
+# 各下载线程预留的磁盘空间
+disk_reservations = []
+disk_space_condition = threading.Condition()
+# 下载线程不能读取输入，磁盘空间不足时通过该队列请主线程询问用户
+disk_space_prompts = queue.Queue()
+
+def format_size(size):
+    return f"{size / 1024 ** 3:.2f} GB"
+
+# 统计下载任务临时文件（及 N_m3u8DL-RE 临时目录）已占用的磁盘空间
+def get_temp_usage(save_dir, temp_name):
+    total = 0
+    try:
+        entries = os.listdir(save_dir)
+    except OSError:
+        return 0
+
+    for entry in entries:
+        if not entry.startswith(temp_name):
+            continue
+        path = os.path.join(save_dir, entry)
+        try:
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+            else:
+                total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+# 同一磁盘上其他下载任务已预留但尚未写入的空间
+def get_pending_reserved_size(device):
+    return sum(max(0, reservation['size'] - get_temp_usage(reservation['save_dir'], reservation['temp_name']))
+               for reservation in disk_reservations if reservation['device'] == device)
+
+# 下载前预留磁盘空间；预计占用超过水位线时暂停，等待其他下载完成或询问用户
+# timeout 不为 None 时不询问用户，等待超时后返回 None（用于后台校验等可以放弃的任务）
+def reserve_disk_space(save_dir, temp_name, size, timeout=None):
+    device = os.stat(save_dir).st_dev
+    reservation = {'device': device, 'save_dir': save_dir, 'temp_name': temp_name, 'size': size}
+    deadline = None if timeout is None else time.time() + timeout
+
+    ignore_space = False
+    while True:
+        with disk_space_condition:
+            usage = shutil.disk_usage(save_dir)
+            required = get_pending_reserved_size(device) + size
+            if ignore_space or (required <= usage.free and usage.used + required <= usage.total * DISK_USAGE_WATERMARK):
+                disk_reservations.append(reservation)
+                return reservation
+
+            message = f"磁盘空间不足（剩余 {format_size(usage.free)}，预计需要 {format_size(required)}）"
+            if deadline is not None and time.time() >= deadline:
+                print(f"{message}，已放弃。")
+                return None
+
+            # 其他下载完成后会释放预留空间，先等待
+            if any(other['device'] == device for other in disk_reservations) or deadline is not None:
+                print(f"{message}，等待其他视频下载完成或清理磁盘后继续...")
+                disk_space_condition.wait(timeout=60 if deadline is None else min(60, max(0, deadline - time.time())))
+                continue
+
+        # 询问用户时不持有锁，避免阻塞其他线程释放预留空间；下载线程由主线程代为询问
+        message += "。请清理磁盘后按Enter重新检查，或输入s忽略并继续下载: "
+        if threading.current_thread() is threading.main_thread():
+            choice = input(message)
+        else:
+            answer = queue.Queue(maxsize=1)
+            disk_space_prompts.put((message, answer))
+            choice = answer.get()
+        if choice.lower() == 's':
+            ignore_space = True
+
+# 主线程代下载线程询问用户磁盘空间不足时如何处理，timeout 为等待询问请求的时间
+def handle_disk_space_prompts(timeout=0):
+    while True:
+        try:
+            message, answer = disk_space_prompts.get(timeout=timeout) if timeout else disk_space_prompts.get_nowait()
+        except queue.Empty:
+            return
+        answer.put(input(message))
+        timeout = 0
+
+def release_disk_space(reservation):
+    with disk_space_condition:
+        disk_reservations.remove(reservation)
+        disk_space_condition.notify_all()
+
+# 预先分配文件空间，系统不支持 fallocate 时跳过
+def preallocate_file(output, size):
+    if size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(output.fileno(), 0, size)
+        return True
+    except OSError as e:
+        print(f"预分配磁盘空间失败: {e}")
+        return False
+
+# 多个下载线程同时完成时，避免选中同一个文件名
+finalize_lock = threading.Lock()
+
+# 下载成功后将临时文件原子重命名为正式文件名，返回重命名后的文件路径
+# 已存在同名文件时依次使用 "名称 (2)"、"名称 (3)" 等，不覆盖已有的视频
+def finalize_output(save_dir, temp_name, final_name):
+    with finalize_lock:
+        suffixes = [entry[len(temp_name):] for entry in os.listdir(save_dir)
+                    if entry.startswith(temp_name + '.') and os.path.isfile(os.path.join(save_dir, entry))]
+
+        name = final_name
+        number = 1
+        while any(os.path.exists(os.path.join(save_dir, name + suffix)) for suffix in suffixes):
+            number += 1
+            name = f"{final_name} ({number})"
+
+        final_paths = []
+        for suffix in suffixes:
+            final_path = os.path.join(save_dir, name + suffix)
+            os.replace(os.path.join(save_dir, temp_name + suffix), final_path)
+            final_paths.append(final_path)
+    return final_paths
+
+# 分片缓存目录及容量上限，超出上限时按最近最少使用的顺序删除
+SEGMENT_CACHE_DIR = os.path.join(os.getcwd(), 'Cache')
+SEGMENT_CACHE_LIMIT = 20 * 1024 ** 3
+# 是否通过本地缓存代理运行 N_m3u8DL-RE
+USE_SEGMENT_CACHE_PROXY = True
+# 代理转发给钉钉 CDN 的请求头（不转发 Accept-Encoding，保证缓存的是原始数据）
+PROXY_FORWARD_HEADERS = ('Cookie', 'User-Agent', 'Referer', 'Accept', 'Accept-Language', 'Range')
+# entries 为 {缓存键: 文件大小}，按最近使用时间排序，首次使用时从缓存目录加载
+segment_cache = {'lock': threading.Lock(), 'entries': None, 'size': 0}
+segment_cache_proxy = {'lock': threading.Lock(), 'server': None}
+
+# 分片缓存键：去掉签名参数后的链接路径，同一分片在不同签名下可以共用缓存
+def get_segment_cache_key(url):
+    return hashlib.sha256(urlparse(url).path.encode('utf-8')).hexdigest()
+
+def get_segment_cache_path(key):
+    return os.path.join(SEGMENT_CACHE_DIR, key[:2], key)
+
+# 扫描缓存目录，按修改时间（即最近使用时间）建立 LRU 索引，需在持有锁时调用
+def load_segment_cache():
+    if segment_cache['entries'] is not None:
         return
-    
+
+    files = []
+    for root, _, names in os.walk(SEGMENT_CACHE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                if name.endswith(TEMP_SUFFIX):
+                    # 上次运行中断时遗留的临时文件
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+
+    files.sort()
+    segment_cache['entries'] = OrderedDict((name, size) for _, name, size in files)
+    segment_cache['size'] = sum(size for _, _, size in files)
+
+def read_segment_cache(url):
+    key = get_segment_cache_key(url)
+    with segment_cache['lock']:
+        load_segment_cache()
+        if key not in segment_cache['entries']:
+            return None
+        segment_cache['entries'].move_to_end(key)
+
+    path = get_segment_cache_path(key)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        # 更新修改时间，作为下次启动时的最近使用时间
+        os.utime(path)
+    except OSError:
+        with segment_cache['lock']:
+            segment_cache['size'] -= segment_cache['entries'].pop(key, 0)
+        return None
+    return data
+
+def remove_segment_cache(url):
+    key = get_segment_cache_key(url)
+    with segment_cache['lock']:
+        load_segment_cache()
+        segment_cache['size'] -= segment_cache['entries'].pop(key, 0)
+    try:
+        os.remove(get_segment_cache_path(key))
+    except OSError:
+        pass
+
+# 删除最久未使用的分片，需在持有锁时调用
+def evict_oldest_segment():
+    old_key, old_size = segment_cache['entries'].popitem(last=False)
+    segment_cache['size'] -= old_size
+    try:
+        os.remove(get_segment_cache_path(old_key))
+    except OSError:
+        pass
+    return old_size
+
+# 分片缓存不能占用下载任务预留的磁盘空间，超过水位线时先删除最久未使用的分片，
+# 删除全部缓存也不足时不写入缓存，也不删除已有的分片；需在持有锁时调用
+def make_segment_cache_room(size):
+    device = os.stat(SEGMENT_CACHE_DIR).st_dev
+    usage = shutil.disk_usage(SEGMENT_CACHE_DIR)
+    with disk_space_condition:
+        # 下载任务已写入的部分包含在 used 中，只计算尚未写入的预留空间
+        required = get_pending_reserved_size(device) + size
+    shortage = max(required - usage.free, usage.used + required - usage.total * DISK_USAGE_WATERMARK)
+    if shortage > segment_cache['size']:
+        return False
+    while shortage > 0 and segment_cache['entries']:
+        shortage -= evict_oldest_segment()
+    return True
+
+# 写入分片缓存，超出容量上限时删除最久未使用的分片；写入失败不影响下载
+def write_segment_cache(url, data):
+    key = get_segment_cache_key(url)
+    path = get_segment_cache_path(key)
+    temp_path = f"{path}.{threading.get_ident()}{TEMP_SUFFIX}"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with segment_cache['lock']:
+            load_segment_cache()
+            if not make_segment_cache_room(len(data)):
+                return
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"写入分片缓存时发生错误: {e}")
+        return
+
+    with segment_cache['lock']:
+        entries = segment_cache['entries']
+        segment_cache['size'] += len(data) - entries.pop(key, 0)
+        entries[key] = len(data)
+        while segment_cache['size'] > SEGMENT_CACHE_LIMIT and len(entries) > 1:
+            evict_oldest_segment()
+
+# 本地缓存代理，代理链接格式为 http://127.0.0.1:端口/{mode}/{scheme}/{host}/{path}?{query}
+# mode 为 segment 时按链接路径缓存（仅用于播放列表中的媒体分片），为 direct 时只转发不缓存
+class SegmentCacheProxyHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass  # 不输出访问日志
+
+    def do_GET(self):
+        parts = self.path.lstrip('/').split('/', 3)
+        if len(parts) < 4 or parts[0] not in ('segment', 'direct') or parts[1] not in ('http', 'https'):
+            self.send_error(400)
+            return
+        upstream_url = f"{parts[1]}://{parts[2]}/{parts[3]}"
+        # Range 请求不缓存
+        cacheable = parts[0] == 'segment' and 'Range' not in self.headers
+
+        try:
+            if cacheable:
+                data = read_segment_cache(upstream_url)
+                if data is not None:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+
+            request_headers = {name: self.headers[name] for name in PROXY_FORWARD_HEADERS if name in self.headers}
+            try:
+                response = open_url(upstream_url, request_headers)
+            except urllib.error.HTTPError as e:
+                # 原样返回状态码，N_m3u8DL-RE 输出 403 后会触发重新解析链接
+                self.send_error(e.code, e.reason)
+                return
+            except Exception as e:
+                self.send_error(502, str(e))
+                return
+
+            data = bytearray()
+            with response:
+                self.send_response(response.status)
+                for name in ('Content-Type', 'Content-Length', 'Content-Range'):
+                    if response.headers.get(name):
+                        self.send_header(name, response.headers[name])
+                self.end_headers()
+                while True:
+                    chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    if cacheable:
+                        data += chunk
+
+            if cacheable and response.status == 200:
+                write_segment_cache(upstream_url, bytes(data))
+        except ConnectionError:
+            # N_m3u8DL-RE 提前断开连接
+            pass
+
+def get_segment_cache_proxy_port():
+    with segment_cache_proxy['lock']:
+        if segment_cache_proxy['server'] is None:
+            server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SegmentCacheProxyHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            segment_cache_proxy['server'] = server
+            print(f"已启动本地分片缓存代理，端口: {server.server_port}")
+        return segment_cache_proxy['server'].server_port
+
+def get_proxy_url(url, cacheable=False):
+    parsed_url = urlparse(url)
+    mode = 'segment' if cacheable else 'direct'
+    proxy_url = f"http://127.0.0.1:{get_segment_cache_proxy_port()}/{mode}/{parsed_url.scheme}/{parsed_url.netloc}{parsed_url.path}"
+    return f"{proxy_url}?{parsed_url.query}" if parsed_url.query else proxy_url
+
+# 生成供 N_m3u8DL-RE 使用的播放列表：媒体分片改写为可缓存的代理链接，
+# 密钥链接只转为绝对链接、不经过代理，密钥不会写入磁盘缓存
+def write_proxy_playlist(m3u8_file, base_url):
+    proxy_file = os.path.splitext(m3u8_file)[0] + '_proxy.m3u8'
+    with open(m3u8_file, 'r', encoding='utf-8') as f, open(proxy_file, 'w', encoding='utf-8') as proxy_f:
+        for line in f:
+            stripped = line.strip()
+            if stripped and not stripped.startswith('#'):
+                line = get_proxy_url(urljoin(base_url, stripped), cacheable=True) + '\n'
+            elif stripped.startswith('#EXT-X-KEY:'):
+                line = re.sub(r'URI="([^"]+)"', lambda match: f'URI="{urljoin(base_url, match.group(1))}"', line)
+            elif 'URI="' in line:
+                # EXT-X-MAP 为媒体初始化分片，可以缓存；其他标签中的链接只转发
+                cacheable = stripped.startswith('#EXT-X-MAP:')
+                line = re.sub(r'URI="([^"]+)"', lambda match: f'URI="{get_proxy_url(urljoin(base_url, match.group(1)), cacheable)}"', line)
+            proxy_f.write(line)
+    return proxy_file
+
+# 内置下载器的并发线程数
+NATIVE_DOWNLOAD_THREADS = 8
+# 单个分片下载失败（非 403）时的重试次数
+SEGMENT_RETRY_TIMES = 3
+# 读取网络数据的块大小
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# 替换文件名中不允许使用的字符
+def get_safe_filename(name):
+    return re.sub(r'[\\/:*?"<>|\r\n]', '_', name).strip() or 'output'
+
+# 解析 m3u8 标签中的属性列表，例如 METHOD=AES-128,URI="..."
+def parse_m3u8_attributes(text):
+    attributes = {}
+    for name, value in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', text):
+        attributes[name] = value.strip('"')
+    return attributes
+
+# 解析 m3u8 播放列表，分片和密钥的相对链接基于 base_url 拼接
+def parse_m3u8_playlist(m3u8_file, base_url):
+    playlist = {
+        'target_duration': None,
+        'media_sequence': 0,
+        'discontinuity_sequence': 0,
+        'endlist': False,
+        'bandwidth': None,
+        'segments': [],
+        'variants': [],
+    }
+    key = None
+    duration = 0.0
+    sequence = 0
+    variant_bandwidth = None
+
+    with open(m3u8_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#EXT-X-TARGETDURATION:'):
+                playlist['target_duration'] = float(line.split(':', 1)[1])
+            elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+                sequence = int(line.split(':', 1)[1])
+                playlist['media_sequence'] = sequence
+            elif line.startswith('#EXT-X-DISCONTINUITY-SEQUENCE:'):
+                playlist['discontinuity_sequence'] = int(line.split(':', 1)[1])
+            elif line.startswith('#EXT-X-KEY:'):
+                attributes = parse_m3u8_attributes(line.split(':', 1)[1])
+                method = attributes.get('METHOD', 'NONE')
+                if method == 'NONE':
+                    key = None
+                else:
+                    key = {
+                        'method': method,
+                        'uri': urljoin(base_url, attributes.get('URI', '')),
+                        'iv': attributes.get('IV'),
+                    }
+            elif line.startswith('#EXTINF:'):
+                duration = float(line.split(':', 1)[1].split(',')[0])
+            elif line.startswith('#EXT-X-BITRATE:'):
+                # EXT-X-BITRATE 的单位为 kbps
+                playlist['bandwidth'] = int(line.split(':', 1)[1]) * 1000
+            elif line.startswith('#EXT-X-STREAM-INF:'):
+                bandwidth = parse_m3u8_attributes(line.split(':', 1)[1]).get('BANDWIDTH')
+                variant_bandwidth = int(bandwidth) if bandwidth and bandwidth.isdigit() else None
+            elif line == '#EXT-X-ENDLIST':
+                playlist['endlist'] = True
+            elif variant_bandwidth is not None:
+                # 多码率主播放列表中的子播放列表
+                playlist['variants'].append({'uri': urljoin(base_url, line), 'bandwidth': variant_bandwidth})
+                playlist['bandwidth'] = max(playlist['bandwidth'] or 0, variant_bandwidth)
+                variant_bandwidth = None
+            elif not line.startswith('#'):
+                playlist['segments'].append({
+                    'sequence': sequence,
+                    'uri': urljoin(base_url, line),
+                    'duration': duration,
+                    'key': key,
+                })
+                sequence += 1
+                duration = 0.0
+
+    return playlist
+
+# 未能从播放列表获取码率时，用于估算文件大小的默认码率（bps）
+DEFAULT_BANDWIDTH = 2 * 1000 * 1000
+
+# 根据 EXTINF 和码率统计播放列表的总时长、分片数量和预计文件大小
+def get_playlist_stats(m3u8_file, base_url):
+    try:
+        playlist = parse_m3u8_playlist(m3u8_file, base_url)
+    except Exception as e:
+        print(f"解析播放列表时发生错误: {e}")
+        return {'duration': 0.0, 'segment_count': 0, 'estimated_size': 0}
+
+    duration = sum(segment['duration'] for segment in playlist['segments'])
+    bandwidth = playlist['bandwidth'] or DEFAULT_BANDWIDTH
+    return {
+        'duration': duration,
+        'segment_count': len(playlist['segments']),
+        'estimated_size': int(duration * bandwidth / 8),
+    }
+
+# 判断播放列表是否使用 AES-128 加密（SAMPLE-AES 等其他方式仍交给 N_m3u8DL-RE 处理）
+def is_aes128_playlist(playlist):
+    methods = {segment['key']['method'] for segment in playlist['segments'] if segment['key']}
+    return methods == {'AES-128'}
+
+# 构建内置下载器使用的请求头
+def build_request_headers(cookies_data=None, headers=None):
+    request_headers = {}
+    if headers:
+        for name in ('User-Agent', 'Referer', 'Accept', 'Accept-Language'):
+            if name in headers:
+                request_headers[name] = headers[name]
+    request_headers.setdefault('User-Agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
+    request_headers.setdefault('Referer', 'https://n.dingtalk.com/')
+    if cookies_data:
+        request_headers['Cookie'] = "; ".join([f"{name}={value}" for name, value in cookies_data.items()])
+    return request_headers
+
+def open_url(url, request_headers, timeout=30):
+    return urllib.request.urlopen(urllib.request.Request(url, headers=request_headers), timeout=timeout)
+
+def create_key_cache():
+    return {'lock': threading.Lock(), 'keys': {}}
+
+# 获取 AES-128 密钥，同一任务中每个密钥 URI 只请求一次并缓存在内存中
+def get_hls_key(key_uri, key_cache, request_headers):
+    with key_cache['lock']:
+        if key_uri not in key_cache['keys']:
+            with open_url(key_uri, request_headers) as response:
+                key = response.read()
+            if len(key) != 16:
+                raise ValueError(f"密钥长度无效: {len(key)} 字节")
+            key_cache['keys'][key_uri] = key
+        return key_cache['keys'][key_uri]
+
+# 未指定 IV 时，按 HLS 规范使用分片序号作为 IV
+def get_segment_iv(segment):
+    iv = segment['key']['iv']
+    if iv:
+        return bytes.fromhex(iv[2:] if iv.lower().startswith('0x') else iv)
+    return segment['sequence'].to_bytes(16, 'big')
+
+# 下载单个分片，加密分片在读取过程中流式解密，不产生额外的磁盘文件
+def download_segment(segment, key_cache, request_headers):
+    decryptor = None
+    if segment['key'] is not None:
+        key = get_hls_key(segment['key']['uri'], key_cache, request_headers)
+        decryptor = Cipher(algorithms.AES(key), modes.CBC(get_segment_iv(segment))).decryptor()
+        unpadder = padding.PKCS7(128).unpadder()
+
+    # 优先从本地分片缓存读取，缓存中保存的是未解密的原始数据
+    raw_data = read_segment_cache(segment['uri'])
+    from_cache = raw_data is not None
+    if not from_cache:
+        raw_data = bytearray()
+
+    data = bytearray()
+    with (io.BytesIO(raw_data) if from_cache else open_url(segment['uri'], request_headers)) as response:
+        while True:
+            chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            if not from_cache:
+                raw_data += chunk
+            if decryptor is not None:
+                chunk = unpadder.update(decryptor.update(chunk))
+            data += chunk
+
+    if decryptor is not None:
+        try:
+            data += unpadder.update(decryptor.finalize())
+            data += unpadder.finalize()
+        except ValueError:
+            # 缓存中的数据已损坏时删除缓存，重试时从网络重新下载
+            if from_cache:
+                remove_segment_cache(segment['uri'])
+            raise
+
+    # 解密和去除填充成功后再写入缓存，避免缓存损坏的分片
+    if not from_cache:
+        write_segment_cache(segment['uri'], bytes(raw_data))
+    return bytes(data)
+
+# 下载分片，403 直接抛出以便重新解析链接，其他错误重试
+def download_segment_with_retry(segment, key_cache, request_headers):
+    last_error = None
+    for attempt in range(SEGMENT_RETRY_TIMES):
+        try:
+            return download_segment(segment, key_cache, request_headers)
+        except urllib.error.HTTPError as e:
+            if e.code == 403:
+                raise
+            last_error = e
+        except Exception as e:
+            last_error = e
+    raise last_error
+
+# 使用线程池并发下载分片，并按顺序写入输出文件
+def download_segments(segments, output, key_cache, request_headers, progress):
+    segment_iter = iter(segments)
+    with ThreadPoolExecutor(max_workers=NATIVE_DOWNLOAD_THREADS) as executor:
+        # 限制同时在内存中的分片数量
+        pending = deque()
+        for segment in itertools.islice(segment_iter, NATIVE_DOWNLOAD_THREADS * 2):
+            pending.append((segment, executor.submit(download_segment_with_retry, segment, key_cache, request_headers)))
+
+        try:
+            while pending:
+                segment, future = pending.popleft()
+                data = future.result()
+                output.write(data)
+                # 记录分片在输出文件中的位置，用于下载后的校验和定向修复
+                progress['index'].append({'segment': segment, 'offset': progress['offset'], 'length': len(data)})
+                progress['offset'] += len(data)
+                progress['next_sequence'] = segment['sequence'] + 1
+                progress['done'] += 1
+                print(f"\r已下载分片: {progress['done']}/{progress['total']}", end='', flush=True)
+
+                next_segment = next(segment_iter, None)
+                if next_segment is not None:
+                    pending.append((next_segment, executor.submit(download_segment_with_retry, next_segment, key_cache, request_headers)))
+        except Exception:
+            for _, future in pending:
+                future.cancel()
+            raise
+    print()
+
+# 使用内置下载器下载并解密 AES-128 加密的播放列表，输出为 TS 文件
+def native_download_m3u8(m3u8_file, save_name, save_dir, prefix, cookies_data=None, headers=None, job=None, estimated_size=0):
+    safe_name = get_safe_filename(save_name)
+    temp_name = safe_name + TEMP_SUFFIX
+    temp_path = os.path.join(save_dir, f"{temp_name}.ts")
+    key_cache = create_key_cache()
+    progress = {'next_sequence': None, 'done': 0, 'total': 0, 'offset': 0, 'index': []}
+    success = False
+
+    with open(temp_path, 'wb') as output:
+        preallocate_file(output, estimated_size)
+        while True:
+            playlist = parse_m3u8_playlist(m3u8_file, prefix)
+            # 重新解析链接后，只下载尚未写入的分片
+            segments = [segment for segment in playlist['segments']
+                        if progress['next_sequence'] is None or segment['sequence'] >= progress['next_sequence']]
+            progress['total'] = progress['done'] + len(segments)
+            request_headers = build_request_headers(cookies_data, headers)
+
+            try:
+                download_segments(segments, output, key_cache, request_headers, progress)
+                # 去掉预分配但未使用的空间
+                output.truncate()
+                success = True
+                break
+            except urllib.error.HTTPError as e:
+                print(f"\n下载分片时发生错误: {e}")
+                if e.code != 403 or job is None or not refresh_download_job(job):
+                    break
+            except Exception as e:
+                print(f"\n下载分片时发生错误: {e}")
+                break
+
+            # 使用新的签名链接继续下载，已写入的分片保持不变
+            m3u8_file, prefix, cookies_data = job['m3u8_file'], job['prefix'], job['cookies_data']
+            print("已获取新的 m3u8 链接，继续下载（已完成的分片将被保留）")
+
+    if not success:
+        os.remove(temp_path)
+        print(f"视频下载失败。文件保存路径: {save_dir}")
+        return False
+
+    output_path = finalize_output(save_dir, temp_name, safe_name)[0]
+    print(f"视频下载成功完成。文件保存路径: {output_path}")
+    submit_verification(output_path, playlist, progress['index'], job, cookies_data, headers)
+    return True
+
+# 构建 N_m3u8DL-RE 下载命令，并添加 HTTP 请求头以避免 403 错误
+def build_download_command(m3u8_file, save_name, save_dir, prefix, cookies_data=None, headers=None):
     command = [
         get_executable_name(),
         m3u8_file,
         "--ui-language", "zh-CN",
         "--save-name", save_name,
         "--save-dir", save_dir,
+        # 临时分片与视频保存在同一磁盘，便于统计磁盘占用
+        "--tmp-dir", save_dir,
         "--base-url", prefix,
     ]
     
@@ -487,12 +1345,418 @@ def download_m3u8_with_options(m3u8_file, save_name, prefix, cookies_data=None,
         print("已添加默认请求头")
     
     print(f"总共添加了 {len(headers_added)} 个请求头: {', '.join(headers_added)}")
+    return command
+
+# 执行下载命令并转发输出，检测到 403 时立即结束进程以便重新解析链接
+def run_download_command(command):
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    forbidden = False
+    tail = b''
+    while True:
+        chunk = process.stdout.read1(4096)
+        if not chunk:
+            break
+        sys.stdout.buffer.write(chunk)
+        sys.stdout.flush()
+        # 保留上一段输出的结尾，避免关键字被截断在两段之间
+        if b'403 (Forbidden)' in tail + chunk or b'403 Forbidden' in tail + chunk:
+            forbidden = True
+            print("\n检测到 403 错误，签名链接可能已过期")
+            process.terminate()
+            break
+        tail = chunk[-32:]
+    process.wait()
+    return process.returncode, forbidden
+
+# 执行下载；链接即将过期时提前重新解析，下载中途出现 403 时重新解析并继续下载
+def run_m3u8_download(m3u8_file, save_name, save_dir, prefix, cookies_data=None, headers=None, job=None):
+    if job is not None and is_url_expiring(job['expire_time']):
+        print("m3u8 链接即将过期，正在重新解析...")
+        refresh_download_job(job)
+
+    if job is not None:
+        m3u8_file, prefix, cookies_data = job['m3u8_file'], job['prefix'], job['cookies_data']
+    estimated_size = get_playlist_stats(m3u8_file, prefix)['estimated_size']
+    # 下载过程中使用临时文件名，成功后再重命名，避免中断时留下不完整的视频文件
+    safe_name = get_safe_filename(save_name)
+    temp_name = safe_name + TEMP_SUFFIX
+
+    if is_aes128_playlist(parse_m3u8_playlist(m3u8_file, prefix)):
+        print("检测到 AES-128 加密的播放列表，使用内置下载器下载并解密")
+        reservation = reserve_disk_space(save_dir, temp_name, estimated_size)
+        try:
+            return native_download_m3u8(m3u8_file, save_name, save_dir, prefix, cookies_data, headers, job, estimated_size)
+        finally:
+            release_disk_space(reservation)
+
+    reservation = reserve_disk_space(save_dir, temp_name, estimated_size * MERGE_SPACE_FACTOR)
+    try:
+        while True:
+            if job is not None:
+                m3u8_file, prefix, cookies_data = job['m3u8_file'], job['prefix'], job['cookies_data']
+            if USE_SEGMENT_CACHE_PROXY:
+                # 通过本地缓存代理下载，已缓存的分片直接从本地磁盘读取
+                command = build_download_command(write_proxy_playlist(m3u8_file, prefix), temp_name, save_dir, get_proxy_url(prefix), cookies_data, headers)
+            else:
+                command = build_download_command(m3u8_file, temp_name, save_dir, prefix, cookies_data, headers)
+            returncode, forbidden = run_download_command(command)
+            if returncode == 0 and not forbidden:
+                output_paths = finalize_output(save_dir, temp_name, safe_name)
+                print(f"视频下载成功完成。文件保存路径: {save_dir}")
+                if output_paths:
+                    # 合并后的视频是输出文件中最大的一个
+                    output_path = max(output_paths, key=os.path.getsize)
+                    submit_verification(output_path, parse_m3u8_playlist(m3u8_file, prefix), None, job, cookies_data, headers)
+                return True
+
+            # N_m3u8DL-RE 会保留临时目录中已完成的分片，使用相同的保存名称重新运行时将跳过这些分片
+            if job is None or not refresh_download_job(job):
+                print(f"视频下载失败。文件保存路径: {save_dir}")
+                return False
+            print("已获取新的 m3u8 链接，继续下载（已完成的分片将被保留）")
+    finally:
+        release_disk_space(reservation)
+
+# 后台校验视频的线程数，校验不阻塞后续下载
+VERIFY_THREADS = 2
+# 抽样检查解码错误的分片数量
+VERIFY_SAMPLE_COUNT = 8
+# 视频时长与播放列表总时长允许的最小误差（秒）
+VERIFY_DURATION_TOLERANCE = 2.0
+# 修复视频时等待磁盘空间的最长时间（秒），超时后放弃修复，不阻塞退出程序
+VERIFY_DISK_SPACE_TIMEOUT = 10 * 60
+# 拼接修复时在按播放列表计算的切点前后该范围内（秒）查找视频关键帧
+SPLICE_KEYFRAME_WINDOW = 5.0
+verify_executor = ThreadPoolExecutor(max_workers=VERIFY_THREADS)
+
+# 查找 ffmpeg / ffprobe，优先使用程序目录下的可执行文件
+def get_ffmpeg_tool(name):
+    local_name = f"{name}.exe" if platform.system() == 'Windows' else f"./{name}"
+    if os.path.exists(local_name):
+        return local_name
+    return shutil.which(name)
+
+def probe_duration(path):
+    ffprobe = get_ffmpeg_tool('ffprobe')
+    if not ffprobe:
+        return None
+    result = subprocess.run([ffprobe, '-v', 'error', '-show_entries', 'format=duration',
+                             '-of', 'default=noprint_wrappers=1:nokey=1', path], capture_output=True, text=True)
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return None
+
+# 视频第一个时间戳（秒），HLS 转换的视频通常不从 0 开始
+def probe_start_time(path):
+    ffprobe = get_ffmpeg_tool('ffprobe')
+    if not ffprobe:
+        return 0.0
+    result = subprocess.run([ffprobe, '-v', 'error', '-show_entries', 'format=start_time',
+                             '-of', 'default=noprint_wrappers=1:nokey=1', path], capture_output=True, text=True)
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return 0.0
+
+# 查找离 timestamp（视频自身的时间戳）最近的视频关键帧，没有视频流或找不到时返回原值
+def probe_keyframe_time(path, timestamp):
+    ffprobe = get_ffmpeg_tool('ffprobe')
+    if not ffprobe:
+        return timestamp
+    interval = f"{max(0.0, timestamp - SPLICE_KEYFRAME_WINDOW):.3f}%{timestamp + SPLICE_KEYFRAME_WINDOW:.3f}"
+    result = subprocess.run([ffprobe, '-v', 'error', '-select_streams', 'v:0', '-read_intervals', interval,
+                             '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', path], capture_output=True, text=True)
+    keyframes = []
+    for line in result.stdout.splitlines():
+        fields = line.strip().split(',')
+        if len(fields) >= 2 and 'K' in fields[1]:
+            try:
+                keyframes.append(float(fields[0]))
+            except ValueError:
+                pass
+    return min(keyframes, key=lambda keyframe: abs(keyframe - timestamp)) if keyframes else timestamp
+
+# 使用 ffmpeg 解码并返回错误输出；input_data 不为 None 时通过标准输入传入分片数据
+def scan_decode_errors(ffmpeg, input_args, input_data=None):
+    command = [ffmpeg, '-v', 'error', *input_args, '-f', 'null', '-']
+    if input_data is None:
+        result = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True)
+    else:
+        result = subprocess.run(command, input=input_data, capture_output=True)
+    return result.stderr.decode('utf-8', errors='replace').strip()
+
+# 均匀抽取分片位置，包含第一个和最后一个分片
+def get_sample_positions(count):
+    sample_count = min(VERIFY_SAMPLE_COUNT, count)
+    if sample_count <= 1:
+        return list(range(sample_count))
+    return sorted({round(i * (count - 1) / (sample_count - 1)) for i in range(sample_count)})
+
+def verify_output(output_path, playlist, segment_index=None):
+    """
+    根据播放列表校验下载的视频，返回 (问题列表, 需要重新下载的分片位置列表)。
+    segment_index 为内置下载器记录的分片位置，提供时按分片字节范围解码检查，否则按 EXTINF 时间范围检查。
+    """
+    problems = []
+    failed_positions = set()
+    segments = playlist['segments']
+
+    expected_duration = sum(segment['duration'] for segment in segments)
+    duration = probe_duration(output_path)
+    if duration is None:
+        print("未找到 ffprobe 或无法读取视频时长，跳过时长校验。")
+    elif abs(duration - expected_duration) > max(VERIFY_DURATION_TOLERANCE, expected_duration * 0.01):
+        problems.append(f"视频时长 {duration:.1f} 秒与播放列表总时长 {expected_duration:.1f} 秒不一致")
+        # N_m3u8DL-RE 合并中断时视频末尾缺失，按播放列表时间定位缺失的分片（包括只写入一部分的分片）
+        if segment_index is None and duration < expected_duration:
+            segment_end = 0.0
+            for position, segment in enumerate(segments):
+                segment_end += segment['duration']
+                if segment_end > duration:
+                    failed_positions.add(position)
+
+    if segment_index is None:
+        print("N_m3u8DL-RE 合并后的视频无法按分片统计数量，跳过分片数量校验（缺失的分片会体现在时长校验中）。")
+    elif len(segment_index) != len(segments):
+        problems.append(f"已写入 {len(segment_index)} 个分片，播放列表共 {len(segments)} 个分片")
+        written = {entry['segment']['sequence'] for entry in segment_index}
+        failed_positions.update(position for position, segment in enumerate(segments) if segment['sequence'] not in written)
+
+    ffmpeg = get_ffmpeg_tool('ffmpeg')
+    if not ffmpeg:
+        print("未找到 ffmpeg，跳过解码检查。")
+        return problems, sorted(failed_positions)
+
+    start_times = list(itertools.accumulate([0.0] + [segment['duration'] for segment in segments]))
+    sample_count = len(segment_index) if segment_index is not None else len(segments)
+    with open(output_path, 'rb') as f:
+        for position in get_sample_positions(sample_count):
+            if segment_index is not None:
+                entry = segment_index[position]
+                f.seek(entry['offset'])
+                errors = scan_decode_errors(ffmpeg, ['-i', 'pipe:0'], f.read(entry['length']))
+            else:
+                errors = scan_decode_errors(ffmpeg, ['-nostdin', '-ss', str(start_times[position]),
+                                                     '-t', str(segments[position]['duration']), '-i', output_path])
+            if errors:
+                problems.append(f"第 {position + 1} 个分片解码错误: {errors.splitlines()[0]}")
+                failed_positions.add(position)
+
+    return problems, sorted(failed_positions)
+
+def submit_verification(output_path, playlist, segment_index=None, job=None, cookies_data=None, headers=None, refetch=True):
+    # 校验任务使用独立的播放列表副本，不受后续下载和重新解析链接的影响
+    if job is not None:
+        job = dict(job, m3u8_file=shutil.copyfile(job['m3u8_file'], new_playlist_file()), refresh_count=0)
+    print(f"已加入后台校验: {output_path}")
+    verify_executor.submit(verify_and_repair, output_path, playlist, segment_index, job, cookies_data, headers, refetch)
+
+# 退出前等待后台校验完成，校验时可能需要通过浏览器重新解析链接
+def wait_for_verification():
+    print("正在等待后台校验完成...")
+    verify_executor.shutdown(wait=True)
+
+def verify_and_repair(output_path, playlist, segment_index=None, job=None, cookies_data=None, headers=None, refetch=True):
+    try:
+        problems, failed_positions = verify_output(output_path, playlist, segment_index)
+        if not problems:
+            print(f"视频校验通过: {output_path}")
+            return
+
+        print(f"视频校验未通过: {output_path}")
+        for problem in problems:
+            print(f"  - {problem}")
+        if not failed_positions:
+            print("无法定位出错的分片，请重新下载该视频。")
+            return
+        if not refetch:
+            print(f"共 {len(failed_positions)} 个分片出错，未重新下载。")
+            return
+
+        # 在校验线程中重新下载出错的分片，不阻塞后续下载
+        print(f"将重新下载 {len(failed_positions)} 个出错的分片。")
+        if segment_index is not None and len(segment_index) == len(playlist['segments']):
+            repair_native_output(output_path, playlist, segment_index, failed_positions, job, cookies_data, headers)
+        else:
+            refetch_segment_ranges(output_path, playlist, failed_positions, job, cookies_data, headers)
+    except Exception as e:
+        print(f"校验视频时发生错误: {e}")
+
+# 获取出错分片的最新链接，签名链接即将过期时先重新解析
+def get_refetch_segments(playlist, positions, job):
+    segments = [playlist['segments'][position] for position in positions]
+    if job is None:
+        return segments
+    if is_url_expiring(job['expire_time']):
+        refresh_download_job(job)
+    latest = {segment['sequence']: segment for segment in parse_m3u8_playlist(job['m3u8_file'], job['prefix'])['segments']}
+    return [latest.get(segment['sequence'], segment) for segment in segments]
+
+# 重新下载内置下载器输出中出错的分片，其余分片从原文件复制，生成新文件后原子替换
+def repair_native_output(output_path, playlist, segment_index, failed_positions, job=None, cookies_data=None, headers=None):
+    try:
+        segments = get_refetch_segments(playlist, failed_positions, job)
+        if job is not None:
+            cookies_data = job['cookies_data']
+        request_headers = build_request_headers(cookies_data, headers)
+        key_cache = create_key_cache()
+
+        replacements = {}
+        for position, segment in zip(failed_positions, segments):
+            # 出错的分片可能来自缓存，需要先删除缓存
+            remove_segment_cache(segment['uri'])
+            replacements[position] = download_segment_with_retry(segment, key_cache, request_headers)
+
+        save_dir = os.path.dirname(output_path)
+        root, ext = os.path.splitext(os.path.basename(output_path))
+        temp_name = root + TEMP_SUFFIX
+        temp_path = os.path.join(save_dir, temp_name + ext)
+        # 修复时会生成完整的新文件
+        reservation = reserve_disk_space(save_dir, temp_name, os.path.getsize(output_path), VERIFY_DISK_SPACE_TIMEOUT)
+        if reservation is None:
+            print(f"磁盘空间不足，未修复视频: {output_path}")
+            return
+        try:
+            with open(output_path, 'rb') as src, open(temp_path, 'wb') as dst:
+                for position, entry in enumerate(segment_index):
+                    if position in replacements:
+                        dst.write(replacements[position])
+                    else:
+                        src.seek(entry['offset'])
+                        dst.write(src.read(entry['length']))
+            os.replace(temp_path, output_path)
+        finally:
+            release_disk_space(reservation)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        print(f"已重新下载 {len(replacements)} 个分片并修复视频: {output_path}")
+    except Exception as e:
+        print(f"修复视频时发生错误: {e}")
+
+# 将分片位置合并为连续的区间，例如 [1, 2, 3, 7] -> [(1, 3), (7, 7)]
+def group_positions(positions):
+    ranges = []
+    for position in positions:
+        if ranges and position == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], position)
+        else:
+            ranges.append((position, position))
+    return ranges
+
+# ffmpeg concat 列表中的路径需要用单引号包裹并转义单引号
+def quote_concat_path(path):
+    return "'" + path.replace("'", "'\\''") + "'"
+
+def refetch_segment_ranges(output_path, playlist, failed_positions, job=None, cookies_data=None, headers=None):
+    """
+    修复 N_m3u8DL-RE 合并后的视频：使用 --custom-range 只重新下载出错的分片区间，
+    再用 ffmpeg concat 按分片时间范围把原视频中正常的部分与重新下载的部分拼接成新文件，最后原子替换原视频。
+    """
+    if job is None:
+        print("缺少下载任务信息，无法重新下载出错的分片。")
+        return
+    ffmpeg = get_ffmpeg_tool('ffmpeg')
+    if not ffmpeg:
+        print("未找到 ffmpeg，无法拼接修复后的视频。")
+        return
+
+    segments = playlist['segments']
+    save_dir = os.path.dirname(output_path)
+    root, ext = os.path.splitext(os.path.basename(output_path))
+    temp_name = root + TEMP_SUFFIX
+    temp_paths = []
+    reservation = None
+    try:
+        # 出错的分片可能来自缓存，需要先删除缓存
+        for segment in get_refetch_segments(playlist, failed_positions, job):
+            remove_segment_cache(segment['uri'])
+        m3u8_file, prefix, cookies_data = job['m3u8_file'], job['prefix'], job['cookies_data']
+
+        # 预留重新下载的分片区间和拼接后新文件所需的空间
+        failed_duration = sum(segments[position]['duration'] for position in failed_positions)
+        range_size = int(failed_duration * (playlist.get('bandwidth') or DEFAULT_BANDWIDTH) / 8)
+        reservation = reserve_disk_space(save_dir, temp_name, os.path.getsize(output_path) + range_size * MERGE_SPACE_FACTOR, VERIFY_DISK_SPACE_TIMEOUT)
+        if reservation is None:
+            print(f"磁盘空间不足，未修复视频: {output_path}")
+            return
+
+        # 切点按播放列表时间加上视频起始时间戳，并对齐到最近的关键帧，避免 -c copy 拼接时重复或丢失画面
+        start_times = list(itertools.accumulate([0.0] + [segment['duration'] for segment in segments]))
+        file_start = probe_start_time(output_path)
+        cut_times = {}
+        for start, end in group_positions(failed_positions):
+            for position in (start, end + 1):
+                if 0 < position < len(segments):
+                    cut_times[position] = probe_keyframe_time(output_path, file_start + start_times[position])
+        # 拼接列表，每一项为 (文件路径, 起始时间, 结束时间)，时间为视频自身的时间戳
+        parts = []
+        position = 0
+        for start, end in group_positions(failed_positions):
+            range_name = f"{temp_name}_修复_{start + 1}-{end + 1}"
+            if USE_SEGMENT_CACHE_PROXY:
+                command = build_download_command(write_proxy_playlist(m3u8_file, prefix), range_name, save_dir, get_proxy_url(prefix), cookies_data, headers)
+            else:
+                command = build_download_command(m3u8_file, range_name, save_dir, prefix, cookies_data, headers)
+            command.extend(["--custom-range", f"{start}-{end}"])
+            returncode, _ = run_download_command(command)
+
+            range_paths = [os.path.join(save_dir, entry) for entry in os.listdir(save_dir)
+                           if entry.startswith(range_name + '.') and os.path.isfile(os.path.join(save_dir, entry))]
+            temp_paths.extend(range_paths)
+            if returncode != 0 or not range_paths:
+                print(f"重新下载第 {start + 1}-{end + 1} 个分片失败，视频未修复。")
+                return
+
+            if start > position:
+                parts.append((output_path, cut_times.get(position), cut_times[start]))
+            parts.append((max(range_paths, key=os.path.getsize), None, None))
+            position = end + 1
+        if position < len(segments):
+            parts.append((output_path, cut_times[position], None))
+
+        concat_file = os.path.join(save_dir, f"{temp_name}_concat.txt")
+        temp_output = os.path.join(save_dir, temp_name + ext)
+        temp_paths.extend([concat_file, temp_output])
+        with open(concat_file, 'w', encoding='utf-8') as f:
+            for path, inpoint, outpoint in parts:
+                f.write(f"file {quote_concat_path(os.path.abspath(path))}\n")
+                if inpoint is not None:
+                    f.write(f"inpoint {inpoint:.6f}\n")
+                if outpoint is not None:
+                    f.write(f"outpoint {outpoint:.6f}\n")
+
+        result = subprocess.run([ffmpeg, '-v', 'error', '-nostdin', '-y', '-f', 'concat', '-safe', '0',
+                                 '-i', concat_file, '-c', 'copy', temp_output], capture_output=True)
+        if result.returncode != 0:
+            errors = result.stderr.decode('utf-8', errors='replace').strip()
+            print(f"拼接修复后的视频失败: {errors.splitlines()[0] if errors else result.returncode}")
+            return
 
-    subprocess.run(command)
-    print(f"视频下载成功完成。文件保存路径: {save_dir}")
+        os.replace(temp_output, output_path)
+        print(f"已重新下载 {len(failed_positions)} 个分片并修复视频: {output_path}")
+    except Exception as e:
+        print(f"重新下载出错的分片时发生错误: {e}")
+    finally:
+        for path in temp_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        if reservation is not None:
+            release_disk_space(reservation)
+
+def download_m3u8_with_options(m3u8_file, save_name, prefix, cookies_data=None, headers=None, job=None):
+    root = tk.Tk()
+    root.withdraw()
+    save_dir = filedialog.askdirectory(title="选择保存视频的目录")
+
+    if not save_dir:
+        print("用户取消了选择。视频下载已中止。")
+        return
+    
+    run_m3u8_download(m3u8_file, save_name, save_dir, prefix, cookies_data, headers, job)
 
 # 用于批量下载时，复用保存路径
-def download_m3u8_with_reused_path(m3u8_file, save_name, prefix, saved_path=None, cookies_data=None, headers=None):
+def download_m3u8_with_reused_path(m3u8_file, save_name, prefix, saved_path=None, cookies_data=None, headers=None, job=None):
     # 如果没有提供已保存的路径，则弹出文件选择框
     if saved_path is None:
         root = tk.Tk()
@@ -503,79 +1767,12 @@ def download_m3u8_with_reused_path(m3u8_file, save_name, prefix, saved_path=None
             print("用户取消了选择。视频下载已中止。")
             return
 
-    # 构建下载命令
-    command = [
-        get_executable_name(),
-        m3u8_file,
-        "--ui-language", "zh-CN",
-        "--save-name", save_name,
-        "--save-dir", saved_path,
-        "--base-url", prefix,
-    ]
-    
-    # 添加 HTTP 请求头以避免 403 错误
-    headers_added = []
-    
-    if cookies_data:
-        # 构建 Cookie 字符串
-        cookie_string = "; ".join([f"{name}={value}" for name, value in cookies_data.items()])
-        command.extend(["-H", f"Cookie: {cookie_string}"])
-        headers_added.append("Cookie")
-        print(f"已添加 Cookie 请求头")
-    
-    if headers:
-        # 添加 User-Agent
-        if 'User-Agent' in headers:
-            command.extend(["-H", f"User-Agent: {headers['User-Agent']}"])
-            headers_added.append("User-Agent")
-            print(f"已添加 User-Agent 请求头")
-        else:
-            print("警告: headers 中没有 User-Agent")
-        
-        # 添加 Referer
-        if 'Referer' in headers:
-            command.extend(["-H", f"Referer: {headers['Referer']}"])
-            headers_added.append("Referer")
-            print(f"已添加 Referer 请求头")
-        else:
-            # 如果没有 Referer，添加默认的钉钉直播 Referer
-            command.extend(["-H", "Referer: https://n.dingtalk.com/"])
-            headers_added.append("Referer (默认)")
-            print(f"已添加默认 Referer 请求头")
-        
-        # 添加其他重要的请求头
-        if 'Accept' in headers:
-            command.extend(["-H", f"Accept: {headers['Accept']}"])
-            headers_added.append("Accept")
-            print(f"已添加 Accept 请求头")
-        
-        if 'Accept-Language' in headers:
-            command.extend(["-H", f"Accept-Language: {headers['Accept-Language']}"])
-            headers_added.append("Accept-Language")
-            print(f"已添加 Accept-Language 请求头")
-        
-        if 'Accept-Encoding' in headers:
-            command.extend(["-H", f"Accept-Encoding: {headers['Accept-Encoding']}"])
-            headers_added.append("Accept-Encoding")
-            print(f"已添加 Accept-Encoding 请求头")
-    
-    else:
-        # 如果没有headers，添加一些基本的默认请求头
-        command.extend(["-H", "User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"])
-        command.extend(["-H", "Referer: https://n.dingtalk.com/"])
-        command.extend(["-H", "Accept: application/vnd.apple.mpegurl, text/plain, */*"])
-        headers_added.extend(["User-Agent (默认)", "Referer (默认)", "Accept (默认)"])
-        print("已添加默认请求头")
-    
-    print(f"总共添加了 {len(headers_added)} 个请求头: {', '.join(headers_added)}")
-
-    subprocess.run(command)
-    print(f"视频下载成功完成。文件保存路径: {saved_path}")
+    run_m3u8_download(m3u8_file, save_name, saved_path, prefix, cookies_data, headers, job)
     return saved_path  # 返回已选择的路径，以便后续使用
 
 
 
-def auto_download_m3u8_with_options(m3u8_file, save_name, prefix, cookies_data=None, headers=None):
+def auto_download_m3u8_with_options(m3u8_file, save_name, prefix, cookies_data=None, headers=None, job=None):
     # 获取当前工作目录
     base_dir = os.getcwd()
     
@@ -585,76 +1782,127 @@ def auto_download_m3u8_with_options(m3u8_file, save_name, prefix, cookies_data=N
     # 确保 Downloads 文件夹存在
     os.makedirs(downloads_dir, exist_ok=True)
     
-    # 构建命令
-    command = [
-        get_executable_name(),
-        m3u8_file,
-        "--ui-language", "zh-CN",
-        "--save-name", save_name,
-        "--save-dir", downloads_dir,  # 设置保存目录为 Downloads 文件夹
-        "--base-url", prefix,
-    ]
-    
-    # 添加 HTTP 请求头以避免 403 错误
-    headers_added = []
-    
-    if cookies_data:
-        # 构建 Cookie 字符串
-        cookie_string = "; ".join([f"{name}={value}" for name, value in cookies_data.items()])
-        command.extend(["-H", f"Cookie: {cookie_string}"])
-        headers_added.append("Cookie")
-        print(f"已添加 Cookie 请求头")
-    
-    if headers:
-        # 添加 User-Agent
-        if 'User-Agent' in headers:
-            command.extend(["-H", f"User-Agent: {headers['User-Agent']}"])
-            headers_added.append("User-Agent")
-            print(f"已添加 User-Agent 请求头")
-        else:
-            print("警告: headers 中没有 User-Agent")
-        
-        # 添加 Referer
-        if 'Referer' in headers:
-            command.extend(["-H", f"Referer: {headers['Referer']}"])
-            headers_added.append("Referer")
-            print(f"已添加 Referer 请求头")
-        else:
-            # 如果没有 Referer，添加默认的钉钉直播 Referer
-            command.extend(["-H", "Referer: https://n.dingtalk.com/"])
-            headers_added.append("Referer (默认)")
-            print(f"已添加默认 Referer 请求头")
-        
-        # 添加其他重要的请求头
-        if 'Accept' in headers:
-            command.extend(["-H", f"Accept: {headers['Accept']}"])
-            headers_added.append("Accept")
-            print(f"已添加 Accept 请求头")
-        
-        if 'Accept-Language' in headers:
-            command.extend(["-H", f"Accept-Language: {headers['Accept-Language']}"])
-            headers_added.append("Accept-Language")
-            print(f"已添加 Accept-Language 请求头")
-        
-        if 'Accept-Encoding' in headers:
-            command.extend(["-H", f"Accept-Encoding: {headers['Accept-Encoding']}"])
-            headers_added.append("Accept-Encoding")
-            print(f"已添加 Accept-Encoding 请求头")
-    
-    else:
-        # 如果没有headers，添加一些基本的默认请求头
-        command.extend(["-H", "User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"])
-        command.extend(["-H", "Referer: https://n.dingtalk.com/"])
-        command.extend(["-H", "Accept: application/vnd.apple.mpegurl, text/plain, */*"])
-        headers_added.extend(["User-Agent (默认)", "Referer (默认)", "Accept (默认)"])
-        print("已添加默认请求头")
-    
-    print(f"总共添加了 {len(headers_added)} 个请求头: {', '.join(headers_added)}")
-    
     # 执行命令
-    subprocess.run(command)
-    print(f"视频下载成功完成。文件保存路径: {downloads_dir}")
+    run_m3u8_download(m3u8_file, save_name, downloads_dir, prefix, cookies_data, headers, job)
     
+# 直播录制时播放列表未提供 EXT-X-TARGETDURATION 的默认轮询间隔（秒）
+LIVE_DEFAULT_TARGET_DURATION = 6
+# 直播录制时允许连续获取播放列表失败的次数
+LIVE_MAX_ERRORS = 10
+# 磁盘剩余空间低于该值时停止录制
+LIVE_MIN_FREE_SPACE = 1024 ** 3
+
+# 通过浏览器会话获取直播最新的播放列表
+def fetch_live_playlist(job):
+    with browser_lock:
+        download_m3u8_file(job['link'], job['m3u8_file'], job['headers'])
+    playlist = parse_m3u8_playlist(job['m3u8_file'], job['prefix'])
+
+    # 获取到的是多码率主播放列表时，录制码率最高的子播放列表
+    if playlist['variants'] and not playlist['segments']:
+        variant = max(playlist['variants'], key=lambda variant: variant['bandwidth'])
+        if job.get('variant_bandwidth') != variant['bandwidth']:
+            print(f"获取到多码率主播放列表，录制码率最高的子播放列表（{variant['bandwidth'] / 1000:.0f} kbps）。")
+            job['variant_bandwidth'] = variant['bandwidth']
+        with browser_lock:
+            download_m3u8_file(variant['uri'], job['m3u8_file'], job['headers'])
+        playlist = parse_m3u8_playlist(job['m3u8_file'], job['prefix'])
+    return playlist
+
+def record_live_m3u8(save_name, save_dir, job):
+    """
+    录制正在进行的直播：按目标时长轮询播放列表，根据媒体序号只下载新出现的分片并追加到输出文件，
+    媒体序号重置时从新的序号继续录制，播放列表出现 EXT-X-ENDLIST 或用户按 Ctrl+C 时结束录制。
+    """
+    safe_name = get_safe_filename(save_name)
+    temp_name = safe_name + TEMP_SUFFIX
+    temp_path = os.path.join(save_dir, f"{temp_name}.ts")
+    key_cache = create_key_cache()
+    progress = {'next_sequence': None, 'done': 0, 'total': 0, 'offset': 0, 'index': []}
+    error_count = 0
+    # 上一次获取到的 (媒体序号, 不连续序号)，用于发现直播重新推流
+    last_sequences = None
+
+    print("开始录制直播，按 Ctrl+C 结束录制。")
+    with open(temp_path, 'wb') as output:
+        try:
+            while True:
+                poll_start = time.time()
+                if is_url_expiring(job['expire_time']):
+                    print("m3u8 链接即将过期，正在重新解析...")
+                    # 长时间录制需要多次重新解析，只限制连续失败的次数
+                    if refresh_download_job(job):
+                        job['refresh_count'] = 0
+
+                try:
+                    playlist = fetch_live_playlist(job)
+                except Exception as e:
+                    error_count += 1
+                    print(f"获取直播播放列表时发生错误（第 {error_count} 次）: {e}")
+                    if error_count >= LIVE_MAX_ERRORS:
+                        break
+                    time.sleep(LIVE_DEFAULT_TARGET_DURATION)
+                    continue
+                error_count = 0
+
+                # 直播重新推流时媒体序号会重置为较小的值，此时从新的序号开始录制
+                sequences = (playlist['media_sequence'], playlist['discontinuity_sequence'])
+                if playlist['segments']:
+                    if last_sequences is not None and progress['next_sequence'] is not None and \
+                            (sequences[0] < last_sequences[0] or sequences[1] < last_sequences[1]):
+                        print(f"\n直播媒体序号从 {last_sequences[0]} 重置为 {sequences[0]}，从新的序号继续录制。")
+                        progress['next_sequence'] = None
+                    last_sequences = sequences
+
+                next_sequence = progress['next_sequence']
+                new_segments = [segment for segment in playlist['segments']
+                                if next_sequence is None or segment['sequence'] >= next_sequence]
+                if next_sequence is not None and new_segments and new_segments[0]['sequence'] > next_sequence:
+                    # 轮询不及时或直播端丢失分片，缺失的分片已从播放列表中移除
+                    print(f"\n直播分片缺失: 序号 {next_sequence} - {new_segments[0]['sequence'] - 1}")
+
+                if new_segments:
+                    if shutil.disk_usage(save_dir).free < LIVE_MIN_FREE_SPACE:
+                        print(f"\n磁盘剩余空间不足 {format_size(LIVE_MIN_FREE_SPACE)}，停止录制。")
+                        break
+                    progress['total'] += len(new_segments)
+                    request_headers = build_request_headers(job['cookies_data'], job['headers'])
+                    try:
+                        download_segments(new_segments, output, key_cache, request_headers, progress)
+                    except urllib.error.HTTPError as e:
+                        print(f"\n下载分片时发生错误: {e}")
+                        # 未写入的分片在下次轮询时重新下载
+                        progress['total'] = progress['done']
+                        if e.code != 403 or not refresh_download_job(job):
+                            break
+                        job['refresh_count'] = 0
+                        continue
+
+                if playlist['endlist']:
+                    print("\n直播已结束。")
+                    break
+
+                # 播放列表有更新时按目标时长轮询，没有更新时按一半目标时长轮询，使录制进度保持在直播最新分片附近
+                target_duration = playlist['target_duration'] or LIVE_DEFAULT_TARGET_DURATION
+                interval = target_duration if new_segments else target_duration / 2
+                time.sleep(max(0, interval - (time.time() - poll_start)))
+        except KeyboardInterrupt:
+            print("\n已停止录制。")
+        except Exception as e:
+            print(f"\n录制直播时发生错误: {e}")
+
+    if not progress['index']:
+        os.remove(temp_path)
+        print("未录制到任何分片。")
+        return False
+
+    output_path = finalize_output(save_dir, temp_name, safe_name)[0]
+    print(f"直播录制完成，共 {progress['done']} 个分片。文件保存路径: {output_path}")
+    # 按实际写入的分片校验录制结果，直播分片很快会从播放列表中移除，只报告问题不重新下载
+    recorded_playlist = {'segments': [entry['segment'] for entry in progress['index']]}
+    submit_verification(output_path, recorded_playlist, progress['index'], refetch=False)
+    return True
+
 # 单个下载模式
 def single_mode():
     try:
@@ -666,33 +1914,39 @@ def single_mode():
         browser, cookies_data, m3u8_headers, live_name = get_browser_cookie(dingtalk_url, browser_type)
 
         while True:
-            m3u8_links = fetch_m3u8_links(browser, browser_type, dingtalk_url)
+            # 后台校验可能同时通过浏览器重新解析链接，使用浏览器时需要加锁
+            with browser_lock:
+                m3u8_links = fetch_m3u8_links(browser, browser_type, dingtalk_url)
 
             # print(m3u8_links)
 
             if m3u8_links:
                 for link in m3u8_links:
                     # print(f"当前输入的 m3u8 链接: {link}")
-                    m3u8_file = download_m3u8_file(link, 'output.m3u8', m3u8_headers)
+                    with browser_lock:
+                        m3u8_file = download_m3u8_file(link, new_playlist_file(), m3u8_headers)
+                    job = create_download_job(browser, browser_type, dingtalk_url, link, m3u8_file, cookies_data, m3u8_headers)
                     prefix = extract_prefix(link)
                     # modified_m3u8_file = replace_prefix(m3u8_file, prefix)
                     save_name = live_name
 
                     if save_mode == '1':
-                        auto_download_m3u8_with_options(m3u8_file, save_name, prefix, cookies_data, m3u8_headers)
+                        auto_download_m3u8_with_options(m3u8_file, save_name, prefix, cookies_data, m3u8_headers, job)
                     elif save_mode == '2':
-                        download_m3u8_with_options(m3u8_file, save_name, prefix, cookies_data, m3u8_headers)
+                        download_m3u8_with_options(m3u8_file, save_name, prefix, cookies_data, m3u8_headers, job)
             else:
                 print("未找到包含 'm3u8' 字符的请求链接。")
 
             print('=' * 100)
             dingtalk_url = input("请继续输入钉钉直播分享链接，或输入q退出程序: ")
             if dingtalk_url.lower() == 'q':
+                wait_for_verification()
                 if browser:
                     browser.quit()
                 print("程序已退出。")
                 break
-            cookies_data, m3u8_headers, live_name = repeat_get_browser_cookie(dingtalk_url)
+            with browser_lock:
+                cookies_data, m3u8_headers, live_name = repeat_get_browser_cookie(dingtalk_url)
 
     except KeyboardInterrupt:
         print("\n程序已被用户终止。")
@@ -714,50 +1968,27 @@ def batch_mode():
         save_mode = validate_input("请选择保存模式（输入1：保存到程序默认路径，输入2：手动选择保存路径模式，直接回车默认选择1）: ", ['1', '2'], default_option='1')
         browser_option = validate_input("请选择您使用的浏览器（输入1：Edge，输入2：Chrome，输入3：Firefox，直接回车默认选择1）: ", ['1', '2', '3'], default_option='1')
 
+        schedule_option = validate_input("请选择下载顺序（输入1：表格顺序，输入2：短视频优先，输入3：长视频优先，输入4：按表格优先级列，直接回车默认选择1）: ", ['1', '2', '3', '4'], default_option='1')
+        parallel_count = int(validate_input("请输入同时下载的视频数量（1-8，直接回车默认选择1）: ", [str(i) for i in range(1, 9)], default_option='1'))
+
         browser_type = {'1': 'edge', '2': 'chrome', '3': 'firefox'}[browser_option]
+        schedule_policy = SCHEDULE_POLICIES[schedule_option]
+        priorities = read_links_priority(file_path) if schedule_policy == 'priority' else None
         total_links = len(links_dict)
         print(f"共提取到 {total_links} 个钉钉直播回放分享链接。")
         # 使用第一个链接获取Cookie和直播信息
         first_link = next(iter(links_dict.values()))
         browser, cookies_data, m3u8_headers, live_name = get_browser_cookie(first_link, browser_type)
-        print(f"正在下载第 1 个视频，共 {total_links} 个视频。")
-        m3u8_links = fetch_m3u8_links(browser, browser_type, first_link)
 
         saved_path = None  # 用于保存第一次选择的路径
-
-        if m3u8_links:
-            for link in m3u8_links:
-                m3u8_file = download_m3u8_file(link, 'output.m3u8', m3u8_headers)
-                prefix = extract_prefix(link)
-                save_name = live_name
-
-                if save_mode == '1':
-                    saved_path = auto_download_m3u8_with_options(m3u8_file, save_name, prefix, cookies_data, m3u8_headers)  # 默认下载到 Downloads
-                elif save_mode == '2':
-                    saved_path = download_m3u8_with_reused_path(m3u8_file, save_name, prefix, saved_path, cookies_data, m3u8_headers)  # 手动选择路径
-
-        print('=' * 100)
-        for idx, dingtalk_url in list(links_dict.items())[1:]:
-            print(f"正在下载第 {idx + 1} 个视频，共 {total_links} 个视频。")
-            cookies_data, m3u8_headers, live_name = repeat_get_browser_cookie(dingtalk_url)
-            m3u8_links = fetch_m3u8_links(browser, browser_type, dingtalk_url)
-
-            if m3u8_links:
-                for link in m3u8_links:
-                    m3u8_file = download_m3u8_file(link, 'output.m3u8', m3u8_headers)
-                    prefix = extract_prefix(link)
-                    save_name = live_name
-
-                    if save_mode == '1':
-                        saved_path = auto_download_m3u8_with_options(m3u8_file, save_name, prefix, cookies_data, m3u8_headers)  # 默认下载到 Downloads
-                    elif save_mode == '2':
-                        saved_path = download_m3u8_with_reused_path(m3u8_file, save_name, prefix, saved_path, cookies_data, m3u8_headers)  # 手动选择路径
-            print('=' * 100)
+        saved_path = process_links(links_dict, browser, browser_type, save_mode, saved_path, schedule_policy, priorities, parallel_count,
+                                   first_session=(cookies_data, m3u8_headers, live_name))
 
         # 继续下载
         while True:
             continue_option = input("是否继续输入钉钉直播回放链接表格路径进行下载？(按Enter继续，按q退出程序): ")
             if continue_option.lower() == 'q':
+                wait_for_verification()
                 print("程序已退出。")
                 if browser:
                     browser.quit()
@@ -766,7 +1997,62 @@ def batch_mode():
                 file_path = input("请输入新的钉钉直播回放链接表格路径（支持CSV或Excel格式，可直接将文件拖放进窗口）: ")
                 new_links_dict = read_links_file(file_path)
                 # print(f"共提取到 {len(new_links_dict)} 个新的钉钉直播回放分享链接。")
-                saved_path = repeat_process_links(new_links_dict, browser, browser_type, save_mode)
+                priorities = read_links_priority(file_path) if schedule_policy == 'priority' else None
+                saved_path = repeat_process_links(new_links_dict, browser, browser_type, save_mode, saved_path, schedule_policy, priorities, parallel_count)
+
+    except KeyboardInterrupt:
+        print("\n程序已被用户终止。")
+        if browser:
+            browser.quit()
+        sys.exit(0)
+
+    except Exception as e:
+        print(f"发生错误: {e}")
+        if browser:
+            browser.quit()
+
+
+# 直播录制模式
+def live_mode():
+    try:
+        dingtalk_url = input("请输入正在进行的钉钉直播分享链接: ")
+        save_mode = validate_input("请选择保存模式（输入1：保存到程序默认路径，输入2：手动选择保存路径模式，直接回车默认选择1）: ", ['1', '2'], default_option='1')
+        browser_option = validate_input("请选择您使用的浏览器（输入1：Edge，输入2：Chrome，输入3：Firefox，直接回车默认选择1）: ", ['1', '2', '3'], default_option='1')
+
+        browser_type = {'1': 'edge', '2': 'chrome', '3': 'firefox'}[browser_option]
+        browser, cookies_data, m3u8_headers, live_name = get_browser_cookie(dingtalk_url, browser_type)
+
+        if save_mode == '1':
+            save_dir = os.path.join(os.getcwd(), 'Downloads')
+            os.makedirs(save_dir, exist_ok=True)
+        else:
+            root = tk.Tk()
+            root.withdraw()
+            save_dir = filedialog.askdirectory(title="选择保存视频的目录")
+            if not save_dir:
+                print("用户取消了选择。直播录制已中止。")
+                browser.quit()
+                return
+
+        # 录制过程中会通过浏览器重新解析链接，使用浏览器时需要加锁
+        with browser_lock:
+            m3u8_links = fetch_m3u8_links(browser, browser_type, dingtalk_url)
+        if m3u8_links:
+            link = m3u8_links[0]
+            with browser_lock:
+                m3u8_file = download_m3u8_file(link, new_playlist_file(), m3u8_headers)
+            job = create_download_job(browser, browser_type, dingtalk_url, link, m3u8_file, cookies_data, m3u8_headers)
+            # 录制文件名带上开始时间，避免与回放下载的文件重名
+            save_name = f"{live_name}_{time.strftime('%Y%m%d_%H%M%S')}"
+            record_live_m3u8(save_name, save_dir, job)
+        else:
+            print("未找到包含 'm3u8' 字符的请求链接。")
+
+        print('=' * 100)
+        wait_for_verification()
+        if browser:
+            browser.quit()
+        print("程序已退出。")
 
     except KeyboardInterrupt:
         print("\n程序已被用户终止。")
@@ -788,11 +2074,13 @@ if __name__ == "__main__":
     print("===============================================")
 
     try:
-        download_mode = validate_input("请选择下载模式（输入1：单个视频下载模式，输入2：批量下载模式，直接回车默认选择1）: ", ['1', '2'], default_option='1')
+        download_mode = validate_input("请选择下载模式（输入1：单个视频下载模式，输入2：批量下载模式，输入3：直播录制模式，直接回车默认选择1）: ", ['1', '2', '3'], default_option='1')
         if download_mode == '1':
             single_mode()
         elif download_mode == '2':
             batch_mode()
+        elif download_mode == '3':
+            live_mode()
 
     except KeyboardInterrupt:
         print("\n程序已被用户终止。")
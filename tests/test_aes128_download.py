@@ -0,0 +1,107 @@
+import functools
+import http.server
+import importlib.util
+import os
+import tempfile
+import threading
+import unittest
+
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+
+# 主程序文件名包含连字符，需要按路径加载
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'DingTalk-Live-Playback-Download-Tool.py')
+spec = importlib.util.spec_from_file_location('dingtalk_tool', SCRIPT_PATH)
+tool = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(tool)
+
+
+def encrypt_segment(data, key, iv):
+    padder = padding.PKCS7(128).padder()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return encryptor.update(padder.update(data) + padder.finalize()) + encryptor.finalize()
+
+
+class FixtureHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        # 记录每个路径的请求次数，忽略签名参数
+        path = self.path.split('?')[0]
+        with self.server.hits_lock:
+            self.server.hits[path] = self.server.hits.get(path, 0) + 1
+        self.path = path
+        super().do_GET()
+
+
+class AES128DownloadTest(unittest.TestCase):
+    SEGMENT_COUNT = 12
+    MEDIA_SEQUENCE = 5
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        root = self.temp_dir.name
+        self.serve_dir = os.path.join(root, 'www')
+        self.save_dir = os.path.join(root, 'save')
+        os.makedirs(os.path.join(self.serve_dir, 'live_hp', 'abc'))
+        os.makedirs(self.save_dir)
+        tool.SEGMENT_CACHE_DIR = os.path.join(root, 'Cache')
+        tool.segment_cache['entries'] = None
+        tool.segment_cache['size'] = 0
+
+        key = os.urandom(16)
+        with open(os.path.join(self.serve_dir, 'live_hp', 'abc', 'key.bin'), 'wb') as f:
+            f.write(key)
+
+        # 前一半分片使用播放列表指定的 IV，后一半使用分片序号作为 IV
+        explicit_iv = os.urandom(16)
+        lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:2', f'#EXT-X-MEDIA-SEQUENCE:{self.MEDIA_SEQUENCE}',
+                 f'#EXT-X-KEY:METHOD=AES-128,URI="abc/key.bin",IV=0x{explicit_iv.hex()}']
+        self.plain_segments = []
+        for i in range(self.SEGMENT_COUNT):
+            if i == self.SEGMENT_COUNT // 2:
+                lines.append('#EXT-X-KEY:METHOD=AES-128,URI="abc/key.bin"')
+            iv = explicit_iv if i < self.SEGMENT_COUNT // 2 else (self.MEDIA_SEQUENCE + i).to_bytes(16, 'big')
+            data = os.urandom(1000 + i * 37)
+            self.plain_segments.append(data)
+            with open(os.path.join(self.serve_dir, 'live_hp', 'abc', f'{i}.ts'), 'wb') as f:
+                f.write(encrypt_segment(data, key, iv))
+            lines += ['#EXTINF:2.0,', f'abc/{i}.ts?auth_key=9999999999-0-0-sign']
+        lines.append('#EXT-X-ENDLIST')
+
+        self.m3u8_file = os.path.join(root, 'output.m3u8')
+        with open(self.m3u8_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines))
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(FixtureHandler, directory=self.serve_dir))
+        self.server.hits = {}
+        self.server.hits_lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.prefix = f'http://127.0.0.1:{self.server.server_port}/live_hp/abc'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.temp_dir.cleanup()
+
+    def test_detects_aes128_playlist(self):
+        playlist = tool.parse_m3u8_playlist(self.m3u8_file, self.prefix)
+        self.assertTrue(tool.is_aes128_playlist(playlist))
+        self.assertEqual(len(playlist['segments']), self.SEGMENT_COUNT)
+
+    def test_decrypts_segments_and_fetches_key_once(self):
+        ok = tool.native_download_m3u8(self.m3u8_file, '测试/直播', self.save_dir, self.prefix)
+        tool.verify_executor.shutdown(wait=True)
+        tool.verify_executor = tool.ThreadPoolExecutor(max_workers=tool.VERIFY_THREADS)
+
+        self.assertTrue(ok)
+        with open(os.path.join(self.save_dir, '测试_直播.ts'), 'rb') as f:
+            self.assertEqual(f.read(), b''.join(self.plain_segments))
+        self.assertEqual(self.server.hits['/live_hp/abc/key.bin'], 1)
+        self.assertEqual(os.listdir(self.save_dir), ['测试_直播.ts'])
+
+
+if __name__ == '__main__':
+    unittest.main()
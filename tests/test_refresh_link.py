@@ -0,0 +1,91 @@
+import importlib.util
+import json
+import os
+import tempfile
+import unittest
+
+
+# 主程序文件名包含连字符，需要按路径加载
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'DingTalk-Live-Playback-Download-Tool.py')
+spec = importlib.util.spec_from_file_location('dingtalk_tool', SCRIPT_PATH)
+tool = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(tool)
+
+LIVE_UUID = 'abc-123'
+DINGTALK_URL = f'https://n.dingtalk.com/dingding/live-room/index.html?roomId=1&liveUuid={LIVE_UUID}'
+
+
+def make_link(expire_time):
+    return f'https://dtliving-sz.dingtalk.com/live_hp/{LIVE_UUID}/normal.m3u8?auth_key={expire_time}-0-0-sign'
+
+
+def make_log(link):
+    return {'message': json.dumps({'message': {'params': {'response': {'url': link}}}}, separators=(',', ':'))}
+
+
+class FakeBrowser:
+    """模拟 Chrome 性能日志：get_log 返回并清空缓冲区，每次加载页面时播放器请求一次 m3u8。"""
+
+    def __init__(self, buffered_links, page_links):
+        self.buffer = [make_log(link) for link in buffered_links]
+        self.page_links = list(page_links)
+
+    def load_page(self):
+        if self.page_links:
+            self.buffer.append(make_log(self.page_links.pop(0)))
+
+    def get_log(self, log_type):
+        logs, self.buffer = self.buffer, []
+        return logs
+
+    def get(self, url):
+        self.load_page()
+
+    def execute_script(self, script, *args):
+        if 'location.reload' in script:
+            self.load_page()
+            return None
+        return '#EXTM3U\n#EXTINF:2.0,\n0.ts\n'
+
+    def get_cookies(self):
+        return [{'name': 'token', 'value': 'new'}]
+
+
+class RefreshDownloadJobTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.m3u8_file = os.path.join(self.temp_dir.name, 'output.m3u8')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def make_job(self, browser):
+        tool.browser = browser
+        return {'browser': browser, 'browser_type': 'chrome', 'dingtalk_url': DINGTALK_URL,
+                'link': make_link(1000), 'm3u8_file': self.m3u8_file, 'headers': {}, 'refresh_count': 0}
+
+    def test_discards_buffered_stale_link(self):
+        browser = FakeBrowser([make_link(1000)], [make_link(2000)])
+        job = self.make_job(browser)
+
+        self.assertTrue(tool.refresh_download_job(job))
+        self.assertEqual(job['link'], make_link(2000))
+        self.assertEqual(job['cookies_data'], {'token': 'new'})
+
+    def test_reloads_until_link_expires_later(self):
+        browser = FakeBrowser([], [make_link(1000), make_link(3000)])
+        job = self.make_job(browser)
+
+        self.assertTrue(tool.refresh_download_job(job))
+        self.assertEqual(job['link'], make_link(3000))
+
+    def test_fails_when_only_old_link_is_found(self):
+        browser = FakeBrowser([], [make_link(1000)] * 3)
+        job = self.make_job(browser)
+
+        self.assertFalse(tool.refresh_download_job(job))
+        self.assertEqual(job['link'], make_link(1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import collections
+import http.server
+import importlib.util
+import os
+import tempfile
+import threading
+import unittest
+import urllib.request
+
+
+# 主程序文件名包含连字符，需要按路径加载
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'DingTalk-Live-Playback-Download-Tool.py')
+spec = importlib.util.spec_from_file_location('dingtalk_tool', SCRIPT_PATH)
+tool = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(tool)
+
+
+class EchoHandler(http.server.BaseHTTPRequestHandler):
+    """返回请求的完整路径（含查询参数），并记录请求次数。"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.hits.append(self.path)
+        body = self.path.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SegmentCacheProxyTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        tool.SEGMENT_CACHE_DIR = os.path.join(self.temp_dir.name, 'Cache')
+        tool.segment_cache['entries'] = None
+        tool.segment_cache['size'] = 0
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), EchoHandler)
+        self.server.hits = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}/live_hp/abc'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.temp_dir.cleanup()
+
+    def fake_disk_usage(self, used, free):
+        DiskUsage = collections.namedtuple('DiskUsage', 'total used free')
+        real_disk_usage = tool.shutil.disk_usage
+        tool.shutil.disk_usage = lambda path: DiskUsage(1000, used, free)
+        self.addCleanup(setattr, tool.shutil, 'disk_usage', real_disk_usage)
+
+    def fetch(self, url):
+        with urllib.request.urlopen(url) as response:
+            return response.read().decode('utf-8')
+
+    def test_segments_are_cached_without_signature(self):
+        first = self.fetch(tool.get_proxy_url(self.base_url + '/abc/0.ts?auth_key=1-0-0-a', cacheable=True))
+        second = self.fetch(tool.get_proxy_url(self.base_url + '/abc/0.ts?auth_key=2-0-0-b', cacheable=True))
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.server.hits), 1)
+
+    def test_direct_requests_are_not_cached(self):
+        first = self.fetch(tool.get_proxy_url(self.base_url + '/api/getKey?id=live1'))
+        second = self.fetch(tool.get_proxy_url(self.base_url + '/api/getKey?id=live2'))
+
+        self.assertTrue(first.endswith('id=live1'))
+        self.assertTrue(second.endswith('id=live2'))
+        self.assertFalse(os.path.exists(tool.SEGMENT_CACHE_DIR))
+
+    def test_proxy_playlist_does_not_route_keys_through_proxy(self):
+        m3u8_file = os.path.join(self.temp_dir.name, 'output.m3u8')
+        with open(m3u8_file, 'w', encoding='utf-8') as f:
+            f.write('#EXTM3U\n#EXT-X-KEY:METHOD=AES-128,URI="/api/getKey?id=live1"\n#EXTINF:2.0,\nabc/0.ts?auth_key=1\n')
+
+        with open(tool.write_proxy_playlist(m3u8_file, self.base_url), 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+
+        self.assertEqual(lines[1], f'#EXT-X-KEY:METHOD=AES-128,URI="http://127.0.0.1:{self.server.server_port}/api/getKey?id=live1"')
+        self.assertIn('/segment/http/', lines[3])
+
+    def test_full_disk_keeps_existing_cache(self):
+        tool.write_segment_cache(self.base_url + '/abc/0.ts', b'0' * 20)
+        self.fake_disk_usage(used=990, free=10)
+
+        tool.write_segment_cache(self.base_url + '/abc/1.ts', b'1' * 5)
+
+        self.assertEqual(tool.read_segment_cache(self.base_url + '/abc/0.ts'), b'0' * 20)
+        self.assertIsNone(tool.read_segment_cache(self.base_url + '/abc/1.ts'))
+
+    def test_written_reservation_is_not_counted_twice(self):
+        tool.write_segment_cache(self.base_url + '/abc/0.ts', b'0' * 20)
+        # 预留 100 字节的下载任务已全部写入，写入的部分已包含在 used 中
+        with open(os.path.join(self.temp_dir.name, 'video' + tool.TEMP_SUFFIX), 'wb') as f:
+            f.write(b'v' * 100)
+        reservation = {'device': os.stat(self.temp_dir.name).st_dev, 'save_dir': self.temp_dir.name,
+                       'temp_name': 'video' + tool.TEMP_SUFFIX, 'size': 100}
+        tool.disk_reservations.append(reservation)
+        self.addCleanup(tool.disk_reservations.remove, reservation)
+        self.fake_disk_usage(used=900, free=100)
+
+        tool.write_segment_cache(self.base_url + '/abc/1.ts', b'1' * 10)
+
+        self.assertEqual(tool.read_segment_cache(self.base_url + '/abc/0.ts'), b'0' * 20)
+        self.assertEqual(tool.read_segment_cache(self.base_url + '/abc/1.ts'), b'1' * 10)
+
+
+if __name__ == '__main__':
+    unittest.main()